@@ -0,0 +1,151 @@
+/* _adif_core.c - Optional C helper for adif_fields.py
+ *
+ * Deleting fields is the hot loop when cleaning large logs. When this
+ * file is built as _adif_core.so next to adif_fields.py, the script loads
+ * it with ctypes and uses it for --delete; otherwise it falls back to the
+ * pure Python implementation with identical output.
+ *
+ * Build:
+ *     cc -O2 -shared -fPIC -o _adif_core.so _adif_core.c
+ */
+
+#include <stddef.h>
+#include <string.h>
+
+static int is_name_start(unsigned char c)
+{
+    return (c >= 'A' && c <= 'Z') || (c >= 'a' && c <= 'z') || c == '_';
+}
+
+static int is_name_char(unsigned char c)
+{
+    return is_name_start(c) || (c >= '0' && c <= '9');
+}
+
+static unsigned char to_upper(unsigned char c)
+{
+    return (c >= 'a' && c <= 'z') ? (unsigned char)(c - 'a' + 'A') : c;
+}
+
+/* Parse a <NAME:LEN> tag starting at s[start] == '<'. On success store the
+ * name length, the offset just past '>' and the value length, and return 1.
+ * Lengths too large to represent are saturated; callers clamp them to the
+ * end of the record anyway. */
+static int parse_tag(const unsigned char *s, size_t len, size_t start,
+                     size_t *name_len, size_t *tag_end, size_t *value_len)
+{
+    size_t i = start + 1;
+    size_t n = 0;
+    size_t digits_start;
+
+    if (i >= len || !is_name_start(s[i]))
+        return 0;
+    while (i < len && is_name_char(s[i]))
+        i++;
+    if (i >= len || s[i] != ':')
+        return 0;
+    *name_len = i - start - 1;
+    i++;
+
+    digits_start = i;
+    while (i < len && s[i] >= '0' && s[i] <= '9') {
+        if (n < ((size_t)-1) / 20)
+            n = n * 10 + (size_t)(s[i] - '0');
+        else
+            n = ((size_t)-1) / 2;
+        i++;
+    }
+    if (i == digits_start || i >= len || s[i] != '>')
+        return 0;
+
+    *tag_end = i + 1;
+    *value_len = n;
+    return 1;
+}
+
+/* Shell-style match of an upper-cased pattern (* and ? wildcards) against
+ * a field name, ignoring the case of the name. */
+static int glob_match(const unsigned char *pat, const unsigned char *name,
+                      size_t name_len)
+{
+    const unsigned char *star = NULL;
+    size_t star_i = 0;
+    size_t i = 0;
+
+    while (i < name_len) {
+        unsigned char c = to_upper(name[i]);
+        if (*pat == '?' || (*pat != '\0' && *pat != '*' && *pat == c)) {
+            pat++;
+            i++;
+        } else if (*pat == '*') {
+            star = pat++;
+            star_i = i;
+        } else if (star != NULL) {
+            pat = star + 1;
+            i = ++star_i;
+        } else {
+            return 0;
+        }
+    }
+    while (*pat == '*')
+        pat++;
+    return *pat == '\0';
+}
+
+static int matches_any(const unsigned char *name, size_t name_len,
+                       const char *const *patterns, size_t npatterns)
+{
+    size_t k;
+
+    for (k = 0; k < npatterns; k++) {
+        if (glob_match((const unsigned char *)patterns[k], name, name_len))
+            return 1;
+    }
+    return 0;
+}
+
+/* Remove every field whose name matches one of the patterns from a single
+ * record (the text before its <eor>), mirroring delete_fields() in
+ * adif_fields.py. out must have room for len bytes. Returns the number of
+ * bytes written to out. */
+size_t adif_delete_fields(const char *record, size_t len, char *out,
+                          const char *const *patterns, size_t npatterns)
+{
+    const unsigned char *s = (const unsigned char *)record;
+    size_t pos = 0;  /* start of text not yet copied to out */
+    size_t scan = 0; /* where to look for the next tag */
+    size_t o = 0;
+
+    while (scan < len) {
+        const unsigned char *lt = memchr(s + scan, '<', len - scan);
+        size_t start, name_len, tag_end, value_len, value_end;
+
+        if (lt == NULL)
+            break;
+        start = (size_t)(lt - s);
+        if (!parse_tag(s, len, start, &name_len, &tag_end, &value_len)) {
+            scan = start + 1;
+            continue;
+        }
+        value_end = tag_end + (value_len < len - tag_end ? value_len : len - tag_end);
+
+        if (matches_any(s + start + 1, name_len, patterns, npatterns)) {
+            /* Keep the text before the field, skip the field and any
+             * spaces or tabs after its value */
+            memcpy(out + o, s + pos, start - pos);
+            o += start - pos;
+            pos = value_end;
+            while (pos < len && (s[pos] == ' ' || s[pos] == '\t'))
+                pos++;
+        } else {
+            memcpy(out + o, s + pos, value_end - pos);
+            o += value_end - pos;
+            pos = value_end;
+        }
+        scan = pos;
+    }
+
+    memcpy(out + o, s + pos, len - pos);
+    o += len - pos;
+    return o;
+}
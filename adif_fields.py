@@ -12,9 +12,45 @@ N3FJP_COMPUTERNAME, N3FJP_StationID, etc.). % is used instead of * to
 avoid shell glob expansion.
 """
 
+import collections
+import ctypes
+import itertools
+import multiprocessing
+import os
+import stat
 import sys
 import re
 import fnmatch
+import tempfile
+
+
+# On bytes, IGNORECASE is cheaper here than spelling out [Ee][Oo][Rr]
+_EOH_RE = re.compile(rb"<EOH>\s*\n?", re.IGNORECASE)
+_EOR_RE = re.compile(rb"<eor>", re.IGNORECASE)
+# Case-sensitive: the character classes already accept either case, and
+# callers upper-case the captured name themselves
+_TAG_RE = re.compile(rb"<([A-Za-z_][A-Za-z0-9_]*):(\d+)>")
+
+
+class _Lengths(dict):
+    """Maps tag length digits to ints; misses fall back to int()."""
+
+    def __missing__(self, digits):
+        return int(digits)
+
+
+# Nearly every field is shorter than 1000 bytes, and a dict hit is about
+# three times cheaper than int() on the matched digits
+_LENGTHS = _Lengths((b"%d" % n, n) for n in range(1000))
+
+# Bytes removed by bytes.strip()
+_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+# Input is read in chunks of this many bytes
+INPUT_BUFFER_SIZE = 1 << 20
+
+# Starting size of the C helper's output buffer; it grows for longer records
+CORE_BUFFER_SIZE = 64 * 1024
 
 
 HELP_TEXT = """\
@@ -35,6 +71,8 @@ Options:
     --delete-<PATTERN>          Delete fields matching pattern
     --output-file <file>        Write to file (default: stdout)
     --override                  Allow replacing existing fields on --add
+    --jobs <N>                  Worker processes for large files
+                                (default: number of CPUs)
     --help, -h                  Show this help message
 
 Wildcards:
@@ -64,6 +102,7 @@ def parse_args(argv):
     override = False
     add_fields = {}
     delete_patterns = []
+    jobs = os.cpu_count() or 1
 
     i = 1
     while i < len(argv):
@@ -77,6 +116,15 @@ def parse_args(argv):
         elif arg == "--override":
             override = True
             i += 1
+        elif arg == "--jobs" and i + 1 < len(argv):
+            try:
+                jobs = int(argv[i + 1])
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print(f"Invalid --jobs value: {argv[i + 1]}", file=sys.stderr)
+                sys.exit(1)
+            i += 2
         elif arg.startswith("--add-") and i + 1 < len(argv):
             field_name = arg[6:]  # strip --add-
             add_fields[field_name] = argv[i + 1]
@@ -95,7 +143,8 @@ def parse_args(argv):
     if not input_file:
         print(
             f"Usage: {argv[0]} <input.adi> [--output-file out.adi] "
-            f"[--add-<field> <value>] [--delete-<pattern>] [--override]",
+            f"[--add-<field> <value>] [--delete-<pattern>] [--override] "
+            f"[--jobs N]",
             file=sys.stderr,
         )
         print(f"Try '{argv[0]} --help' for more information.", file=sys.stderr)
@@ -106,146 +155,512 @@ def parse_args(argv):
         print(f"Try '{argv[0]} --help' for more information.", file=sys.stderr)
         sys.exit(1)
 
-    return input_file, output_file, add_fields, delete_patterns, override
+    return input_file, output_file, add_fields, delete_patterns, override, jobs
+
+
+class FieldConflictError(Exception):
+    """An --add field already exists with a different value and no --override."""
 
 
 def format_field(name, value):
-    return f"<{name}:{len(value)}>{value}"
+    return b"<%s:%d>%s" % (name, len(value), value)
 
 
-def matches_any_pattern(field_name, patterns):
-    """Check if field_name matches any of the patterns (case-insensitive).
+def compile_patterns(patterns):
+    """Prepare --delete patterns for matching (case-insensitive).
 
-    Patterns use % as wildcard, converted to * for fnmatch.
+    Patterns use % as wildcard, converted to * for fnmatch. Exact names
+    (e.g. Contest_ID) go in a set, a literal prefix ending in a single %
+    (e.g. APP%) becomes a plain prefix test, and all other patterns are
+    combined into one regex. Field names are matched as bytes.
     """
+    exact = set()
+    prefixes = []
+    globs = []
     for pattern in patterns:
-        glob_pattern = pattern.replace("%", "*")
-        if fnmatch.fnmatch(field_name.upper(), glob_pattern.upper()):
-            return True
-    return False
+        glob_pattern = pattern.replace("%", "*").upper()
+        prefix = glob_pattern[:-1]
+        if not any(c in glob_pattern for c in "*?["):
+            exact.add(os.fsencode(glob_pattern))
+        elif glob_pattern.endswith("*") and not any(c in prefix for c in "*?["):
+            prefixes.append(os.fsencode(prefix))
+        else:
+            globs.append(fnmatch.translate(glob_pattern))
+    regex = re.compile(os.fsencode("|".join(globs))) if globs else None
+    return frozenset(exact), tuple(prefixes), regex
 
 
-def delete_fields(record_text, patterns):
+def matches_any_pattern(field_name, patterns):
+    """Check if an upper-cased field_name matches any of the compiled patterns."""
+    exact, prefixes, regex = patterns
+    if field_name in exact or field_name.startswith(prefixes):
+        return True
+    return regex is not None and regex.fullmatch(field_name) is not None
+
+
+def compile_fields(fields):
+    """Prepare --add fields for splicing into records.
+
+    Returns a (NAME, field_name, VALUE, new field) tuple per field, where
+    NAME and VALUE are the upper-cased argument bytes used for comparisons
+    and new field is the formatted tag and value.
+    """
+    compiled = []
+    for field_name, field_value in fields.items():
+        name = os.fsencode(field_name)
+        value = os.fsencode(field_value)
+        compiled.append((name.upper(), field_name, value.upper(), format_field(name, value)))
+    return compiled
+
+
+class Record:
+    """One record's text plus the field tags found in it.
+
+    tags lists (NAME, tag_start, tag_end, value_end) for every field in
+    order, with NAME upper-cased. fields maps each name to its first tag.
+    """
+
+    def __init__(self, text, tags):
+        self.text = text
+        self.tags = tags
+        self.fields = {}
+        for tag in tags:
+            self.fields.setdefault(tag[0], tag)
+
+
+def index_record(record_text):
+    """Scan a record once and index its field tags.
+
+    Each match resumes after the value, so tag-like text inside a value
+    is never mistaken for a field.
+    """
+    # One regex search per tag beats hopping between '<', ':' and '>' with
+    # bytes.find in Python; the C helper does the byte-level scan instead
+    tags = []
+    pos = 0
+    while (m := _TAG_RE.search(record_text, pos)) is not None:
+        # Clamp oversized lengths to the record, as the C helper does
+        value_end = min(m.end() + _LENGTHS[m.group(2)], len(record_text))
+        tags.append((m.group(1).upper(), m.start(), m.end(), value_end))
+        pos = value_end
+    return Record(record_text, tags)
+
+
+def delete_fields(record, patterns):
     """Remove all ADIF fields matching any of the glob patterns.
 
     Uses the length encoded in each tag to consume the full value,
-    including values that contain spaces.
+    including values that contain spaces. Returns a new Record whose
+    tags point into the rewritten text.
     """
-    result = []
-    pos = 0
-    for m in re.finditer(r"<([A-Za-z_][A-Za-z0-9_]*):(\d+)>", record_text):
-        field_name = m.group(1)
-        value_len = int(m.group(2))
-        value_end = m.end() + value_len
+    record_text = record.text
+    # Cut deleted fields out of one mutable copy rather than joining the
+    # slices in between
+    result = bytearray(record_text)
+    kept = []
+    removed = 0
+    for tag in record.tags:
+        field_name, tag_start, tag_end, value_end = tag
 
         if matches_any_pattern(field_name, patterns):
-            # Keep any text before this field, but strip trailing whitespace
-            # that preceded this tag
-            before = record_text[pos:m.start()]
-            result.append(before)
-            # Skip optional trailing whitespace after the value
+            # Drop the field and any optional whitespace after its value
             skip = value_end
-            while skip < len(record_text) and record_text[skip] in (" ", "\t"):
+            while skip < len(record_text) and record_text[skip] in b" \t":
                 skip += 1
-            pos = skip
+            del result[tag_start - removed : skip - removed]
+            removed += skip - tag_start
+        elif removed:
+            kept.append((field_name, tag_start - removed, tag_end - removed, value_end - removed))
         else:
-            # Keep everything from current pos through end of value
-            result.append(record_text[pos:value_end])
-            pos = value_end
+            kept.append(tag)
 
-    # Append any remaining text after the last field
-    result.append(record_text[pos:])
-    return "".join(result)
+    return Record(bytes(result), kept)
 
 
-def add_fields(record_text, fields, override, record_num):
-    """Add or replace fields in a record."""
-    for field_name, field_value in fields.items():
-        pattern = re.compile(
-            rf"<({re.escape(field_name)}):(\d+)>",
-            re.IGNORECASE,
+def _load_core():
+    """Load the optional C helper built from _adif_core.c, if present."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_adif_core.so")
+    try:
+        core = ctypes.CDLL(path)
+        delete = core.adif_delete_fields
+    except (OSError, AttributeError):
+        # Missing, unloadable, or a stale build without the entry point
+        return None
+    delete.argtypes = (
+        ctypes.c_char_p,
+        ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_char),
+        ctypes.POINTER(ctypes.c_char_p),
+        ctypes.c_size_t,
+    )
+    delete.restype = ctypes.c_size_t
+    return core
+
+
+_core = _load_core()
+
+
+def core_delete(patterns):
+    """Return a C-backed equivalent of delete_fields for these patterns.
+
+    The result takes and returns record text. Returns None when
+    _adif_core.so has not been built, or when a pattern needs more than
+    the % and ? wildcards on ASCII names, so the Python code is used.
+    """
+    if _core is None:
+        return None
+    globs = [pattern.replace("%", "*").upper() for pattern in patterns]
+    if not all(glob.isascii() and "[" not in glob for glob in globs):
+        return None
+    glob_array = (ctypes.c_char_p * len(globs))(*(glob.encode() for glob in globs))
+    buffer = ctypes.create_string_buffer(CORE_BUFFER_SIZE)
+
+    def delete(record_text):
+        nonlocal buffer
+        if len(record_text) > len(buffer):
+            buffer = ctypes.create_string_buffer(len(record_text))
+        size = _core.adif_delete_fields(
+            record_text, len(record_text), buffer, glob_array, len(globs)
         )
-        existing = pattern.search(record_text)
+        return ctypes.string_at(buffer, size)
 
-        if existing:
+    return delete
+
+
+def _is_multiline(record_text):
+    """Check for a newline between the first and last non-blank bytes.
+
+    Same result as b"\n" in record_text.strip(), without copying the record.
+    """
+    start = 0
+    end = len(record_text)
+    while start < end and record_text[start] in _WHITESPACE:
+        start += 1
+    while end > start and record_text[end - 1] in _WHITESPACE:
+        end -= 1
+    return record_text.find(b"\n", start, end) != -1
+
+
+def sniff_multiline(block):
+    """Check whether records in block have one field per line.
+
+    Looks at the first record with at least two fields, since a single
+    field says nothing about the layout. Blocks without one are inline.
+    """
+    pos = 0
+    for eor_match in _EOR_RE.finditer(block):
+        record_text = block[pos : eor_match.start()]
+        pos = eor_match.end()
+        tags = _TAG_RE.finditer(record_text)
+        if next(tags, None) is not None and next(tags, None) is not None:
+            return _is_multiline(record_text)
+    return False
+
+
+def add_fields(record, fields, override, record_num, multiline):
+    """Add or replace fields in a record and return the new record text.
+
+    multiline selects where new fields go: each on its own line, or
+    appended inline before <eor>.
+    """
+    record_text = record.text
+    replacements = {}  # tag_start -> (value_end, new field)
+    additions = {}  # NAME -> new field, appended before <eor>
+    values = {}  # NAME -> VALUE set by an earlier --add for this record
+
+    for key, field_name, value_upper, new_field in fields:
+        existing = record.fields.get(key)
+
+        if key in values:
+            old_value = values[key]
+        elif existing:
             # Extract current value using the length from the tag
-            old_value_len = int(existing.group(2))
-            old_end = existing.end() + old_value_len
-            old_value = record_text[existing.end():old_end]
+            old_value = record_text[existing[2]:existing[3]].upper()
+        else:
+            old_value = None
 
-            if old_value.upper() == field_value.upper():
+        if old_value is not None:
+            if old_value == value_upper:
                 continue  # Same value, skip silently
 
             if not override:
-                print(
-                    f"Error: Record {record_num} already has field "
+                raise FieldConflictError(
+                    f"Record {record_num} already has field "
                     f"<{field_name}> with a different value. "
-                    f"Use --override to replace.",
-                    file=sys.stderr,
+                    f"Use --override to replace."
                 )
-                sys.exit(1)
+
+        values[key] = value_upper
+        if existing:
+            replacements[existing[1]] = (existing[3], new_field)
+        else:
+            additions[key] = new_field
+
+    if replacements:
+        parts = []
+        pos = 0
+        for tag_start in sorted(replacements):
+            value_end, new_field = replacements[tag_start]
+            parts.append(record_text[pos:tag_start])
+            parts.append(new_field)
+            pos = value_end
+        parts.append(record_text[pos:])
+        record_text = b"".join(parts)
+
+    if additions:
+        # Insert before <eor> in the file's format (one-per-line vs inline)
+        if multiline:
+            # Keep the record's own line endings (N3FJP writes CRLF)
+            newline = b"\r\n" if b"\r\n" in record_text else b"\n"
             record_text = (
-                record_text[:existing.start()]
-                + format_field(field_name, field_value)
-                + record_text[old_end:]
+                record_text.rstrip() + newline + newline.join(additions.values()) + newline
             )
         else:
-            # Insert before <eor>: detect format (one-per-line vs inline)
-            if record_text.rstrip().endswith("\n") or "\n" in record_text.strip():
-                record_text = record_text.rstrip() + "\n" + format_field(field_name, field_value) + "\n"
-            else:
-                record_text = record_text + format_field(field_name, field_value) + " "
+            record_text = record_text + b" ".join(additions.values()) + b" "
 
     return record_text
 
 
-def process(content, add_flds, del_patterns, override):
-    # Split header from body at <EOH>
-    eoh_match = re.search(r"<EOH>\s*\n?", content, re.IGNORECASE)
-    if eoh_match:
-        header = content[: eoh_match.end()]
-        body = content[eoh_match.end() :]
-    else:
-        header = ""
-        body = content
+class Rewriter:
+    """Applies the --delete and --add options to blocks of whole records."""
+
+    def __init__(self, add_flds, del_patterns, override, multiline):
+        self.patterns = compile_patterns(del_patterns)
+        self.fast_delete = core_delete(del_patterns) if del_patterns else None
+        self.delete = bool(del_patterns)
+        self.fields = compile_fields(add_flds)
+        self.override = override
+        self.multiline = multiline
+
+    def rewrite(self, block, records_before):
+        """Rewrite every record in block; records_before numbers them for errors."""
+        fast_delete = self.fast_delete
+        fields = self.fields
+        record_num = records_before
+        # Find <eor> with a plain substring search over a lower-cased copy
+        # of the block, then slice the original so the tag keeps its case
+        folded = block.lower()
+        out = []
+        pos = 0
+
+        while (eor_start := folded.find(b"<eor>", pos)) != -1:
+            record_num += 1
+            record_text = block[pos:eor_start]
+
+            # Deletes first, then adds
+            if fast_delete:
+                record_text = fast_delete(record_text)
+                if fields:
+                    record = index_record(record_text)
+            else:
+                # Both passes share the one tag scan
+                record = index_record(record_text)
+                if self.delete:
+                    record = delete_fields(record, self.patterns)
+                record_text = record.text
+
+            if fields:
+                record_text = add_fields(
+                    record, fields, self.override, record_num, self.multiline
+                )
 
-    result = header
-    pos = 0
-    record_num = 0
+            out.append(record_text)
+            out.append(block[eor_start : eor_start + 5])
+            pos = eor_start + 5
 
-    for eor_match in re.finditer(r"<eor>", body, re.IGNORECASE):
-        record_num += 1
-        record_text = body[pos : eor_match.start()]
-        eor_tag = eor_match.group()
+        # Any trailing content after the last <eor> is passed through
+        out.append(block[pos:])
+        return b"".join(out)
 
-        # Deletes first, then adds
-        if del_patterns:
-            record_text = delete_fields(record_text, del_patterns)
 
-        if add_flds:
-            record_text = add_fields(record_text, add_flds, override, record_num)
+def iter_blocks(infile):
+    """Split an ADIF stream into its header and blocks of whole records.
 
-        result += record_text + eor_tag
-        pos = eor_match.end()
+    Yields the header first (empty if the file has none), then one
+    (block, records_before) pair per input chunk, where each block ends
+    with an <eor> and records_before counts the records ahead of it. Any
+    text after the final <eor> is appended to the last block, so input
+    of one chunk or less is always a single block. Only a couple of input
+    chunks are held in memory at a time.
+    """
+    buf = b""
+    eof = False
+    while True:
+        # Header ends at <EOH>; an <eor> seen first means there is no header
+        eoh_match = _EOH_RE.search(buf)
+        eor_match = _EOR_RE.search(buf)
+        if eoh_match and (eor_match is None or eoh_match.start() < eor_match.start()):
+            # Trailing whitespace after <EOH> may continue in the next chunk
+            if eoh_match.end() < len(buf) or eof:
+                yield buf[: eoh_match.end()]
+                buf = buf[eoh_match.end() :]
+                break
+        elif eor_match or eof:
+            yield b""
+            break
+        chunk = infile.read(INPUT_BUFFER_SIZE)
+        eof = not chunk
+        buf += chunk
+
+    records_before = 0
+    block = None
+    while not eof:
+        chunk = infile.read(INPUT_BUFFER_SIZE)
+        eof = not chunk
+        buf += chunk
+        folded = buf.lower()
+        end = folded.rfind(b"<eor>")
+        if end != -1:
+            end += 5
+            # Hold each block back until the next one exists, so the
+            # trailing text can join the last block
+            if block is not None:
+                yield block
+            block = (buf[:end], records_before)
+            records_before += folded.count(b"<eor>", 0, end)
+            buf = buf[end:]
+
+    if block is None:
+        yield buf, records_before
+    else:
+        yield block[0] + buf, block[1]
 
-    # Append any trailing content after the last <eor>
-    result += body[pos:]
-    return result
 
+# Rewriter for the current worker process, set up by _init_worker
+_worker_rewriter = None
+
+
+def _init_worker(add_flds, del_patterns, override, multiline):
+    global _worker_rewriter
+    _worker_rewriter = Rewriter(add_flds, del_patterns, override, multiline)
 
-def main():
-    input_file, output_file, add_flds, del_patterns, override = parse_args(sys.argv)
 
-    with open(input_file, "r") as f:
-        content = f.read()
+def _rewrite_in_worker(block, records_before):
+    return _worker_rewriter.rewrite(block, records_before)
 
-    output = process(content, add_flds, del_patterns, override)
 
-    if output_file:
-        with open(output_file, "w") as f:
-            f.write(output)
+def process(infile, add_flds, del_patterns, override, jobs=1):
+    """Rewrite an ADIF stream, yielding the output a block at a time.
+
+    When the input is more than one block and jobs > 1, blocks are
+    rewritten in that many worker processes. Output order is unchanged
+    and only a few blocks are in flight at once.
+    """
+    blocks = iter_blocks(infile)
+    header = next(blocks)
+    first = next(blocks)
+    second = next(blocks, None)
+    # Loggers don't mix layouts within a file, so check one record only
+    multiline = sniff_multiline(first[0])
+
+    if second is None or jobs <= 1:
+        rewriter = Rewriter(add_flds, del_patterns, override, multiline)
+        # The header goes out with the first block, so a small file that
+        # fails part way through writes nothing
+        yield header + rewriter.rewrite(*first)
+        if second is not None:
+            yield rewriter.rewrite(*second)
+            for block, records_before in blocks:
+                yield rewriter.rewrite(block, records_before)
+        return
+
+    blocks = itertools.chain((first, second), blocks)
+
+    with multiprocessing.Pool(
+        jobs, initializer=_init_worker, initargs=(add_flds, del_patterns, override, multiline)
+    ) as pool:
+        pending = collections.deque()
+        for block, records_before in blocks:
+            pending.append(pool.apply_async(_rewrite_in_worker, (block, records_before)))
+            if len(pending) > 2 * jobs:
+                yield header + pending.popleft().get()
+                header = b""
+        while pending:
+            yield header + pending.popleft().get()
+            header = b""
+
+
+# Paths under these are devices or process files, never plain output files
+_SPECIAL_DIRS = ("/dev/", "/proc/")
+
+
+def _replace_safely(output_file, real_path, target):
+    """Check whether output_file can be written via a temp file and rename.
+
+    target is the os.stat() of the resolved path, or None if it does not
+    exist yet. Renaming over the file would change what it is (a device),
+    drop its other hard links or its owner, or needs a writable directory.
+    """
+    if os.path.abspath(output_file).startswith(_SPECIAL_DIRS) or real_path.startswith(_SPECIAL_DIRS):
+        return False
+    if not os.access(os.path.dirname(real_path), os.W_OK | os.X_OK):
+        return False
+    if target is None:
+        return True
+    if not stat.S_ISREG(target.st_mode) or target.st_nlink > 1:
+        return False
+    euid = os.geteuid() if hasattr(os, "geteuid") else None
+    return euid is None or euid == 0 or target.st_uid == euid
+
+
+def write_output(output, output_file):
+    """Write output chunks to output_file, leaving it untouched on failure.
+
+    Where possible the output goes to a temporary file beside the resolved
+    target (following symlinks) and is moved over it only once every chunk
+    is written, so an error part way through, or rewriting the input in
+    place, never truncates existing data. Targets that cannot be replaced
+    that way, such as /dev/stdout, are written directly.
+    """
+    real_path = os.path.realpath(output_file)
+    try:
+        target = os.stat(real_path)
+    except FileNotFoundError:
+        target = None
+
+    if not _replace_safely(output_file, real_path, target):
+        with open(output_file, "wb") as out:
+            out.writelines(output)
+        return
+
+    if target is None:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
     else:
-        sys.stdout.write(output)
+        mode = stat.S_IMODE(target.st_mode)
+
+    directory = os.path.dirname(real_path)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".adif_fields-", delete=False) as out:
+        try:
+            out.writelines(output)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+    os.chmod(out.name, mode)
+    if target is not None and hasattr(os, "chown"):
+        try:
+            os.chown(out.name, target.st_uid, target.st_gid)
+        except PermissionError:
+            pass  # Group not ours to give; the owner already matches
+    os.replace(out.name, real_path)
+
+
+def main():
+    input_file, output_file, add_flds, del_patterns, override, jobs = parse_args(sys.argv)
+
+    with open(input_file, "rb") as infile:
+        output = process(infile, add_flds, del_patterns, override, jobs)
+
+        try:
+            if output_file:
+                write_output(output, output_file)
+            else:
+                sys.stdout.buffer.writelines(output)
+        except FieldConflictError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,37 +2,64 @@
 """Convert N3FJP-style ADIF (one field per line) to one record per line."""
 
 import sys
-import re
+
+
+# Input is read in chunks of this many bytes
+INPUT_BUFFER_SIZE = 1 << 20
+
+# Output is collected and written in blocks of roughly this many bytes
+OUTPUT_BUFFER_SIZE = 64 * 1024
 
 
 def convert(infile, outfile):
     in_header = True
     record_fields = []
+    pending = []
+    pending_size = 0
+
+    def flush():
+        nonlocal pending_size
+        # The empty last item supplies the final newline, so the block is
+        # built and handed to the binary stream in one piece
+        pending.append(b"")
+        outfile.write(b"\n".join(pending))
+        pending.clear()
+        pending_size = 0
+
+    def emit(out_line):
+        nonlocal pending_size
+        pending.append(out_line)
+        pending_size += len(out_line) + 1
+        if pending_size >= OUTPUT_BUFFER_SIZE:
+            flush()
 
     for line in infile:
-        line = line.rstrip("\r\n")
+        line = line.rstrip(b"\r\n")
 
         if in_header:
-            outfile.write(line + "\n")
-            if re.match(r"<EOH>", line, re.IGNORECASE):
+            emit(line)
+            if line[:5].lower() == b"<eoh>":
                 in_header = False
             continue
 
         stripped = line.strip()
         if not stripped:
             if record_fields:
-                outfile.write(" ".join(record_fields) + "\n")
+                emit(b" ".join(record_fields))
                 record_fields = []
             continue
 
         record_fields.append(stripped)
-        if re.search(r"<eor>", stripped, re.IGNORECASE):
-            outfile.write(" ".join(record_fields) + "\n")
+        if stripped[-5:].lower() == b"<eor>":
+            emit(b" ".join(record_fields))
             record_fields = []
 
     # flush any trailing record without a blank line after it
     if record_fields:
-        outfile.write(" ".join(record_fields) + "\n")
+        emit(b" ".join(record_fields))
+
+    if pending:
+        flush()
 
 
 HELP_TEXT = """\
@@ -73,12 +100,12 @@ def main():
     inpath = sys.argv[1]
     outpath = sys.argv[2] if len(sys.argv) > 2 else None
 
-    with open(inpath, "r") as f:
+    with open(inpath, "rb", buffering=INPUT_BUFFER_SIZE) as f:
         if outpath:
-            with open(outpath, "w") as out:
+            with open(outpath, "wb") as out:
                 convert(f, out)
         else:
-            convert(f, sys.stdout)
+            convert(f, sys.stdout.buffer)
 
 
 if __name__ == "__main__":